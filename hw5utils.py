@@ -1,6 +1,59 @@
 import datetime
+import struct
 from textwrap import dedent
 
+# pre-compiled little-endian structs for the fixed-width fields
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+# MFT entry header: $LogFile sequence number (8), sequence (16), links (18), flags (22)
+_ENTRY_HEADER = struct.Struct("<8xQHH2xH")
+
+# windows timestamps count 100ns ticks from 1601-01-01; this is the unix epoch in those ticks
+_EPOCH_OFFSET = 116444736000000000
+_TICKS_PER_SECOND = 10000000
+
+# NTFS attribute flag bits and their istat labels, in output order
+_FLAGS = (
+    (0x0001, "Read Only "),
+    (0x0002, "Hidden "),
+    (0x0004, "System "),
+    (0x0020, "Archive "),
+    (0x0040, "Device "),
+    (0x0080, "Normal "),
+    (0x0100, "Temporary "),
+    (0x0200, "Sparse file "),
+    (0x0400, "Reparse point "),
+    (0x0800, "Compressed "),
+    (0x1000, "Offline "),
+    (0x2000, "Not indexed "),
+    (0x4000, "Encrypted "),
+)
+
+
+def _nibble_table(shift: int) -> tuple:
+    """Build the 16 flag strings for the nibble of a flag value starting at bit shift"""
+    return tuple("".join(label for mask, label in _FLAGS if (nibble << shift) & mask) for nibble in range(16))
+
+
+# one lookup table per nibble of the low 16 flag bits
+_FLAG_NIBBLES = tuple(_nibble_table(shift) for shift in (0, 4, 8, 12))
+
+_ATTR_NAMES = {
+    0x10: "$STANDARD_INFORMATION (16-0)",
+    0x30: "$FILE_NAME (48-3)",
+    0x80: "$DATA (128-2)",
+}
+
+# attr_to_string templates per type code, with only the sizes left to fill in
+_ATTR_RESIDENT = {
+    code: f"Type: {name}   Name: N/A   Resident   size: {{}}\n" for code, name in _ATTR_NAMES.items()
+}
+_ATTR_NON_RESIDENT = {
+    code: f"Type: {name}   Name: N/A   Non-Resident   size: {{}}  init_size: {{}}"
+    for code, name in _ATTR_NAMES.items()
+}
+
 
 def attr_to_string(type_code: int, size: int, init_size=None) -> str:
     """Convert an attribute to a string.
@@ -13,26 +66,36 @@ def attr_to_string(type_code: int, size: int, init_size=None) -> str:
         str: the string representation of the attribute
 
     """
-    type_name = {
-        0x10: "$STANDARD_INFORMATION (16-0)",
-        0x30: "$FILE_NAME (48-3)",
-        0x80: "$DATA (128-2)",
-    }[type_code]
-
     if init_size:
-        format_str = (
-            f"Type: {type_name}   Name: N/A   " f"Non-Resident   size: {size}  init_size: {init_size}"
-        )
-    else:
-        format_str = f"Type: {type_name}   Name: N/A   Resident   size: {size}\n"
-    return format_str
+        return _ATTR_NON_RESIDENT[type_code].format(size, init_size)
+    return _ATTR_RESIDENT[type_code].format(size)
 
 
 def unpack(data: bytes, signed=False, byteorder="little") -> int:
-    """Unpack a single value from bytes"""
+    """Unpack a single value from bytes of any width (e.g., runlist fields)"""
     return int.from_bytes(data, byteorder=byteorder, signed=signed)
 
 
+def unpack_entry_header(entry: bytes) -> tuple[int, int, int, int]:
+    """Unpack the $LogFile sequence number, sequence, links, and flags of an MFT entry header"""
+    return _ENTRY_HEADER.unpack_from(entry, 0)
+
+
+def unpack_u16(data: bytes, offset: int) -> int:
+    """Unpack an unsigned 2-byte little-endian value at offset"""
+    return _U16.unpack_from(data, offset)[0]
+
+
+def unpack_u32(data: bytes, offset: int) -> int:
+    """Unpack an unsigned 4-byte little-endian value at offset"""
+    return _U32.unpack_from(data, offset)[0]
+
+
+def unpack_u64(data: bytes, offset: int) -> int:
+    """Unpack an unsigned 8-byte little-endian value at offset"""
+    return _U64.unpack_from(data, offset)[0]
+
+
 def get_attr_by_id(attr_id: int, entry: bytes, prev_attr_end: int) -> tuple[bytes, int]:
     """Extract the bytes for an attribute specified by its ID type.
 
@@ -61,95 +124,107 @@ def get_attr_by_id(attr_id: int, entry: bytes, prev_attr_end: int) -> tuple[byte
     return attr_full_entry, curr_attr_end
 
 
+def decode_runlist(attribute: bytes, runlist_offset: int) -> list[tuple[int, int]]:
+    """Decode the data runs of a non-resident attribute.
+
+    input:
+        attribute: bytes, the full attribute including its header
+        runlist_offset: int, the offset of the first run within the attribute
+    output:
+        list: (first_cluster, length) for each run, in order
+    """
+    runs = []
+    first_cluster = 0
+    header = attribute[runlist_offset]
+    while header != 0:
+        # high nibble: size of the offset field, low nibble: size of the length field
+        offset_size = header >> 4
+        length_size = header & 0x0F
+        length_end = runlist_offset + length_size + 1
+        length = unpack(attribute[runlist_offset + 1 : length_end], True)
+        # the offset is signed and relative to the previous run
+        first_cluster += unpack(attribute[length_end : length_end + offset_size], True)
+        runs.append((first_cluster, length))
+        runlist_offset = length_end + offset_size
+        header = attribute[runlist_offset]
+    return runs
+
+
 def flag_dump(value: int) -> str:
     """Convert NTFS attribute flags to strings."""
-    string = ""
-    if value & 0x0001:
-        string = string + "Read Only "
-    if value & 0x0002:
-        string = string + "Hidden "
-    if value & 0x0004:
-        string = string + "System "
-    if value & 0x0020:
-        string = string + "Archive "
-    if value & 0x0040:
-        string = string + "Device "
-    if value & 0x0080:
-        string = string + "Normal "
-    if value & 0x0100:
-        string = string + "Temporary "
-    if value & 0x0200:
-        string = string + "Sparse file "
-    if value & 0x0400:
-        string = string + "Reparse point "
-    if value & 0x0800:
-        string = string + "Compressed "
-    if value & 0x1000:
-        string = string + "Offline "
-    if value & 0x2000:
-        string = string + "Not indexed "
-    if value & 0x4000:
-        string = string + "Encrypted "
-    if string == "":
-        string = str(hex(value) + " (Unknown flag)")
-    return string
-
-
-def apply_fixup(entry: bytes) -> bytes:
-    """Apply the fixup array to an MFT entry"""
-    assert entry[0:4] == b"FILE"
+    string = (
+        _FLAG_NIBBLES[0][value & 0xF]
+        + _FLAG_NIBBLES[1][(value >> 4) & 0xF]
+        + _FLAG_NIBBLES[2][(value >> 8) & 0xF]
+        + _FLAG_NIBBLES[3][(value >> 12) & 0xF]
+    )
+    return string or hex(value) + " (Unknown flag)"
+
+
+def apply_fixup(entry: bytes) -> bytearray:
+    """Apply the fixup array to a copy of an MFT entry"""
+    assert entry.startswith(b"FILE")
     fixup = int.from_bytes(entry[4:6], "little")
     num_fixup_entries = int.from_bytes(entry[6:8], "little")
     fixuprepl = entry[fixup + 2 : fixup + 2 * num_fixup_entries]
-    entry = entry[:510] + fixuprepl[0:2] + entry[512:1022] + fixuprepl[2:4]
-    return entry
+    buf = bytearray(entry)
+    buf[510:512] = fixuprepl[0:2]
+    buf[1022:1024] = fixuprepl[2:4]
+    return buf
+
+
+_HEADER_TMPL = dedent(
+    """\
+    MFT Entry Header Values:
+    Entry: {address}        Sequence: {sequence}
+    $LogFile Sequence Number: {logfile_seq_num}
+    {allocated_str} File
+    Links: {links}
+    """
+)
+
+_STD_INFO_TMPL = dedent(
+    """
+    $STANDARD_INFORMATION Attribute Values:
+    Flags: {flags_str}
+    Owner ID: 0
+    Created:\t{created}
+    File Modified:\t{modified}
+    MFT Modified:\t{mft_modified}
+    Accessed:\t{accessed}
+    """
+)
+
+_FILE_NAME_TMPL = dedent(
+    """
+    $FILE_NAME Attribute Values:
+    Flags: {flags_str}
+    Name: {name}
+    Parent MFT Entry: {parent:<6} Sequence: {sequence}
+    Allocated Size: {allocated_size:<8} Actual Size: {actual_size}
+    Created:\t{created}
+    File Modified:\t{modified}
+    MFT Modified:\t{mft_modified}
+    Accessed:\t{accessed}
+    """
+)
 
 
 def header_to_str(header: dict) -> str:
     """Convert a header dict into a string"""
-    output = dedent(
-        f"""        MFT Entry Header Values:
-        Entry: {header['address']}        Sequence: {header['sequence']}
-        $LogFile Sequence Number: {header['logfile_seq_num']}
-        {"Allocated" if header['allocated'] else "Unallocated"} File
-        Links: {header['links']}
-    """
+    return _HEADER_TMPL.format_map(
+        {**header, "allocated_str": "Allocated" if header["allocated"] else "Unallocated"}
     )
-    return output
 
 
 def std_info_to_str(std_info: dict) -> str:
     """Convert a standard info dict into a string"""
-    output = dedent(
-        f"""
-        $STANDARD_INFORMATION Attribute Values:
-        Flags: {flag_dump(std_info['flags'])}
-        Owner ID: {0}
-        Created:\t{std_info['created']}
-        File Modified:\t{std_info['modified']}
-        MFT Modified:\t{std_info['mft_modified']}
-        Accessed:\t{std_info['accessed']}
-        """
-    )
-    return output
+    return _STD_INFO_TMPL.format_map({**std_info, "flags_str": flag_dump(std_info["flags"])})
 
 
 def file_name_to_str(file_name: dict) -> str:
     """Convert a file name dict into a string"""
-    output = dedent(
-        f"""
-        $FILE_NAME Attribute Values:
-        Flags: {flag_dump(file_name['flags'])}
-        Name: {file_name['name']}
-        Parent MFT Entry: {file_name['parent']:<6} Sequence: {file_name['sequence']}
-        Allocated Size: {file_name['allocated_size']:<8} Actual Size: {file_name['actual_size']}
-        Created:\t{file_name['created']}
-        File Modified:\t{file_name['modified']}
-        MFT Modified:\t{file_name['mft_modified']}
-        Accessed:\t{file_name['accessed']}
-    """
-    )
-    return output
+    return _FILE_NAME_TMPL.format_map({**file_name, "flags_str": flag_dump(file_name["flags"])})
 
 
 def _localtime_string(windows_timestamp: int) -> str:
@@ -161,14 +236,14 @@ def _localtime_string(windows_timestamp: int) -> str:
     :param windows_timestamp: the struct.decoded 8-byte windows timestamp
     :return: an istat-compatible string representation of this time in EDT
     """
-    epoch_ts = (windows_timestamp - 116444736000000000) / 10000000
+    # whole seconds since the unix epoch plus the 100ns ticks left over
+    epoch_secs, fraction = divmod(windows_timestamp - _EPOCH_OFFSET, _TICKS_PER_SECOND)
     if windows_timestamp > 0:
-        dt = datetime.datetime.fromtimestamp(epoch_ts)
+        dt = datetime.datetime.fromtimestamp(epoch_secs)
     else:
-        dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(epoch_ts))
+        dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=epoch_secs)
 
-    hms = dt.strftime("%Y-%m-%d %H:%M:%S")
-    fraction = windows_timestamp % 10000000
+    hms = f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
     return f"{hms}.{fraction:07d}00 (EDT)"
 
 
@@ -182,9 +257,6 @@ def parse_time(attribute: bytes, index_range: tuple) -> str:
         a string representation of the time
     """
     header_length = 24
-    time_value = int.from_bytes(
-        attribute[header_length + index_range[0] : header_length + index_range[1]],
-        byteorder="little",
-        signed=False,
-    )
+    # timestamps are always 8 bytes, so only the start of index_range is needed
+    time_value = unpack_u64(attribute, header_length + index_range[0])
     return _localtime_string(time_value)
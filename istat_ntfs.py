@@ -1,17 +1,30 @@
 import argparse
+import mmap
+import sys
+from itertools import chain
+from typing import Optional
 
 from hw5utils import (
     apply_fixup,
     attr_to_string,
+    decode_runlist,
     file_name_to_str,
     get_attr_by_id,
     header_to_str,
     parse_time,
     std_info_to_str,
     unpack,
+    unpack_entry_header,
+    unpack_u16,
+    unpack_u32,
+    unpack_u64,
 )
 
 
+class MissingAttributeError(ValueError):
+    """Raised when an MFT entry has no attribute of the requested type."""
+
+
 class ParseMFT:
     def __init__(self, file):
         self.file = file
@@ -22,6 +35,60 @@ class ParseMFT:
         mft_start = unpack(boot[48:56])
         self.bytes_per_entry = 1024  # hard coded
         self.mft_byte_offset = mft_start * sectors_per_cluster * bytes_per_sector
+        # map the image once; entries are then sliced out without a seek/read per entry.
+        # file-like objects without a real fd (e.g., BytesIO) and empty files fall back to seek/read
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.mm = None
+
+    def close(self):
+        """Release the memory map of the image, if there is one; the file itself is left open."""
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _read_entry(self, address: int) -> bytes:
+        """Read the raw bytes of an MFT entry from the image."""
+        # assumes contiguous MFT
+        entry_start = self.mft_byte_offset + address * self.bytes_per_entry
+        if self.mm is not None:
+            return self.mm[entry_start : entry_start + self.bytes_per_entry]
+        self.file.seek(entry_start)
+        return self.file.read(self.bytes_per_entry)
+
+    def _index_attrs(self, entry: bytes) -> dict:
+        """Walk the attribute headers of an MFT entry once.
+
+        input:
+            entry: bytes, the MFT entry to index
+        output:
+            dict: {type_code: (start, end)} for the first attribute of each type
+        """
+        attrs = {}
+        attr_start = unpack_u16(entry, 20)
+        while attr_start + 8 <= len(entry):
+            type_code = unpack_u32(entry, attr_start)
+            length = unpack_u32(entry, attr_start + 4)
+            if type_code == 0xFFFFFFFF or length == 0:
+                break
+            attrs.setdefault(type_code, (attr_start, attr_start + length))
+            attr_start += length
+        return attrs
+
+    def _get_attr(
+        self, attr_id: int, entry: bytes, prev_attr_end: int, attrs: Optional[dict] = None
+    ) -> tuple[bytes, int]:
+        """Extract an attribute, from the index if there is one, otherwise by walking the entry.
+
+        Raises MissingAttributeError if the index has no attribute of type attr_id.
+        """
+        if attrs is None:
+            return get_attr_by_id(attr_id, entry, prev_attr_end)
+        if attr_id not in attrs:
+            raise MissingAttributeError(f"MFT entry has no attribute of type {attr_id:#x}")
+        start, end = attrs[attr_id]
+        return entry[start:end], end
 
     def parse_entry_header(self, address: int, entry: bytes) -> dict:
         """Parse the header of the MFT entry.
@@ -40,21 +107,25 @@ class ParseMFT:
 
         """
         # fill this in
-        header_dict = {}
-        header_dict["address"] = address
-        header_dict["sequence"] = unpack(entry[16:18])
-        header_dict["logfile_seq_num"] = unpack(entry[8:16])
-        header_dict["links"] = unpack(entry[18:20])
-        flag = unpack(entry[22:24])
-        header_dict["allocated"] = flag != 0
-        return header_dict
-
-    def parse_std_info_attr(self, entry: bytes, entry_start: int = 0x38) -> dict:
+        logfile_seq_num, sequence, links, flag = unpack_entry_header(entry)
+        return {
+            "address": address,
+            "sequence": sequence,
+            "logfile_seq_num": logfile_seq_num,
+            "links": links,
+            "allocated": flag != 0,
+        }
+
+    def parse_std_info_attr(
+        self, entry: bytes, entry_start: int = 0x38, attrs: Optional[dict] = None
+    ) -> dict:
         """Parse the standard_information attribute of an MFT entry.
 
         input:
             entry: bytes, the MFT entry to parse
             entry_start: int, the offset of the first byte of the attribute
+            attrs: dict, optional attribute index from _index_attrs(); when given, the
+                attribute is looked up there and the offset argument above is ignored
         output:
             dict{
                 'created': int, (the creation time)
@@ -67,26 +138,28 @@ class ParseMFT:
             }
         """
 
-        attribute, std_info_end = get_attr_by_id(0x10, entry, entry_start)
+        attribute, std_info_end = self._get_attr(0x10, entry, entry_start, attrs)
         # fill this in
-        std_info_dict = {}
-        content_offset = unpack(attribute[20:22])
+        content_offset = unpack_u16(attribute, 20)
         content = attribute[content_offset : std_info_end + 1]
-        std_info_dict["created"] = parse_time(attribute, (0, 8))
-        std_info_dict["modified"] = parse_time(attribute, (8, 16))
-        std_info_dict["mft_modified"] = parse_time(attribute, (16, 24))
-        std_info_dict["accessed"] = parse_time(attribute, (24, 32))
-        std_info_dict["flags"] = unpack(content[32:36])
-        std_info_dict["std_info_size"] = unpack(attribute[16:20])
-        std_info_dict["std_info_end"] = std_info_end
-        return std_info_dict
-
-    def parse_file_name_attr(self, entry: bytes, prev_entry_end: int) -> dict:
+        return {
+            "created": parse_time(attribute, (0, 8)),
+            "modified": parse_time(attribute, (8, 16)),
+            "mft_modified": parse_time(attribute, (16, 24)),
+            "accessed": parse_time(attribute, (24, 32)),
+            "flags": unpack_u32(content, 32),
+            "std_info_size": unpack_u32(attribute, 16),
+            "std_info_end": std_info_end,
+        }
+
+    def parse_file_name_attr(self, entry: bytes, prev_entry_end: int, attrs: Optional[dict] = None) -> dict:
         """Parse the file_name attribute of an MFT entry.
 
         input:
             entry: bytes, the MFT entry to parse
             prev_entry_end: int, the offset of the last byte of the previous attribute
+            attrs: dict, optional attribute index from _index_attrs(); when given, the
+                attribute is looked up there and the offset argument above is ignored
         output:
             dict{
                 'name': str, (the name of the file)
@@ -103,32 +176,35 @@ class ParseMFT:
                 'file_name_end': int, (the offset of the next attribute)
             }
         """
-        attribute, file_name_end = get_attr_by_id(0x30, entry, prev_entry_end)
+        attribute, file_name_end = self._get_attr(0x30, entry, prev_entry_end, attrs)
         # fill this in
-        file_name_dict = {}
-        content_offset = unpack(attribute[20:22])
+        content_offset = unpack_u16(attribute, 20)
         content = attribute[content_offset : file_name_end + 1]
-        # file_name_dict["parent"] = unpack(content[2:8])
-        file_name_dict["parent"] = unpack(content[0:6])
-        file_name_dict["sequence"] = unpack(content[6:8])
-        file_name_dict["allocated_size"] = unpack(content[40:48])
-        file_name_dict["actual_size"] = unpack(content[48:56])
-        file_name_dict["created"] = parse_time(attribute, (8, 16))
-        file_name_dict["modified"] = parse_time(attribute, (16, 24))
-        file_name_dict["mft_modified"] = parse_time(attribute, (24, 32))
-        file_name_dict["accessed"] = parse_time(attribute, (32, 40))
-        file_name_dict["flags"] = unpack(content[56:60])
-        file_name_dict["file_name_size"] = unpack(attribute[16:20])
-        file_name_dict["name"] = content[66 : 66 + (content[64] * 2)].decode("utf-16-le")
-        file_name_dict["file_name_end"] = file_name_end
-        return file_name_dict
-
-    def parse_data_attr(self, entry: bytes, prev_attr_end: int) -> dict:
+        name_off = content_offset + 66
+        name_len = attribute[content_offset + 64] * 2
+        return {
+            "parent": unpack(content[0:6]),
+            "sequence": unpack_u16(content, 6),
+            "allocated_size": unpack_u64(content, 40),
+            "actual_size": unpack_u64(content, 48),
+            "created": parse_time(attribute, (8, 16)),
+            "modified": parse_time(attribute, (16, 24)),
+            "mft_modified": parse_time(attribute, (24, 32)),
+            "accessed": parse_time(attribute, (32, 40)),
+            "flags": unpack_u32(content, 56),
+            "file_name_size": unpack_u32(attribute, 16),
+            "name": bytes(attribute[name_off : name_off + name_len]).decode("utf-16-le"),
+            "file_name_end": file_name_end,
+        }
+
+    def parse_data_attr(self, entry: bytes, prev_attr_end: int, attrs: Optional[dict] = None) -> dict:
         """Parse the data attribute of an MFT entry.
 
         input:
             entry: bytes, the MFT entry to parse
             prev_attr_end: int, the offset of the last byte of the previous attribute
+            attrs: dict, optional attribute index from _index_attrs(); when given, the
+                attribute is looked up there and the offset argument above is ignored
         output:
             if the entry is resident:
             dict:
@@ -140,35 +216,19 @@ class ParseMFT:
                 sector_list: list, (the list of non-resident sectors)
 
         """
-        attribute, _ = get_attr_by_id(0x80, entry, prev_attr_end)
+        attribute, _ = self._get_attr(0x80, entry, prev_attr_end, attrs)
         # fill this in
-        data_dict = {}
-        data_dict["type"] = 0x80
         non_res_flag = attribute[8]
         if non_res_flag == 0:
-            data_dict["size"] = unpack(attribute[16:20])
-        else:
-            data_dict["size"] = unpack(attribute[48:56])
-            data_dict["init_size"] = unpack(attribute[56:63])
-            sector_list = []
-            runlist_offset = unpack(attribute[32:34])
-            first_byte = attribute[runlist_offset]
-            prev_first_cluster = 0
-            while first_byte != 0:
-                first_nibble = format(unpack(attribute[runlist_offset : runlist_offset + 1]), "08b")[0:4]
-                second_nibble = format(unpack(attribute[runlist_offset : runlist_offset + 1]), "08b")[4:8]
-                offset_nibble = int(first_nibble, 2)
-                run_length_nibble = int(second_nibble, 2)
-                byte_offset = runlist_offset + run_length_nibble + 1
-                length = unpack(attribute[runlist_offset + 1 : byte_offset], True)
-                cluster = unpack(attribute[byte_offset : byte_offset + offset_nibble], True)
-                prev_first_cluster += cluster
-                curr_sec_list = list(range(prev_first_cluster, prev_first_cluster + length))
-                sector_list += curr_sec_list
-                runlist_offset = byte_offset + offset_nibble
-                first_byte = attribute[runlist_offset]
-            data_dict["sector_list"] = sector_list
-        return data_dict
+            return {"type": 0x80, "size": unpack_u32(attribute, 16)}
+        runs = decode_runlist(attribute, unpack_u16(attribute, 32))
+        return {
+            "type": 0x80,
+            "size": unpack_u64(attribute, 48),
+            "init_size": unpack_u64(attribute, 56),
+            # expand the runs into sectors once, at the end
+            "sector_list": list(chain.from_iterable(range(start, start + length) for start, length in runs)),
+        }
 
     def istat_entry(self, address: int) -> dict:
         """Parse the header, std_info, file_name, and data attributes of an MFT entry.
@@ -182,23 +242,24 @@ class ParseMFT:
                 'file_name': dict, from parse_file_name()
                 'data': dict, from parse_data_attr()
         """
-        # assumes contiguous MFT
-        self.file.seek(self.mft_byte_offset + address * self.bytes_per_entry)
-        entry = self.file.read(1024)
-        entry = apply_fixup(entry)
+        # a memoryview lets the parse_* slices below share the entry's buffer instead of copying
+        entry = memoryview(apply_fixup(self._read_entry(address)))
 
         # fill this in
         # parse the header
         # parse std_info attribute
         # parse filename attribute
         # parse the data attribute
+        attrs = self._index_attrs(entry)
         mft_entry_dict = {}
         mft_entry_dict["header"] = self.parse_entry_header(address, entry)
-        mft_entry_dict["std_info"] = self.parse_std_info_attr(entry)
+        mft_entry_dict["std_info"] = self.parse_std_info_attr(entry, attrs=attrs)
         mft_entry_dict["file_name"] = self.parse_file_name_attr(
-            entry, mft_entry_dict["std_info"]["std_info_end"]
+            entry, mft_entry_dict["std_info"]["std_info_end"], attrs
+        )
+        mft_entry_dict["data"] = self.parse_data_attr(
+            entry, mft_entry_dict["file_name"]["file_name_end"], attrs
         )
-        mft_entry_dict["data"] = self.parse_data_attr(entry, mft_entry_dict["file_name"]["file_name_end"])
         return mft_entry_dict
 
     def istat_mft(self) -> dict:
@@ -211,24 +272,25 @@ class ParseMFT:
         std_info_attr = istat_entry["std_info"]
         header_entry = istat_entry["header"]
 
-        result = (
-            header_to_str(header_entry)
-            + std_info_to_str(std_info_attr)
-            + file_name_to_str(file_name_attr)
-            + "\nAttributes:\n"
-            + attr_to_string(0x10, std_info_attr["std_info_size"])
-            + attr_to_string(0x30, file_name_attr["file_name_size"])
-        )
+        parts = [
+            header_to_str(header_entry),
+            std_info_to_str(std_info_attr),
+            file_name_to_str(file_name_attr),
+            "\nAttributes:\n",
+            attr_to_string(0x10, std_info_attr["std_info_size"]),
+            attr_to_string(0x30, file_name_attr["file_name_size"]),
+        ]
         if "init_size" in data_attr:
-            result += attr_to_string(0x80, data_attr["size"], data_attr["init_size"])
+            parts.append(attr_to_string(0x80, data_attr["size"], data_attr["init_size"]))
         else:
-            result += attr_to_string(0x80, data_attr["size"])
+            parts.append(attr_to_string(0x80, data_attr["size"]))
         if "sector_list" in data_attr:
-            result += "\n"
+            parts.append("\n")
             sector_list = data_attr["sector_list"]
-            for x in range(0, len(sector_list), 8):
-                result += " ".join([str(x) for x in sector_list[x : x + 8]]) + "\n"
-        return result
+            parts.extend(
+                " ".join(map(str, sector_list[x : x + 8])) + "\n" for x in range(0, len(sector_list), 8)
+            )
+        return "".join(parts)
 
 
 def main():
@@ -241,8 +303,13 @@ def main():
 
     with open(args.image, "rb") as fd:
         ntfs = ParseMFT(fd)
-        result = ntfs.istat_entry(args.address)
-        print(ntfs.print_istat_entry(result))
+        try:
+            result = ntfs.istat_entry(args.address)
+            print(ntfs.print_istat_entry(result))
+        except MissingAttributeError as e:
+            sys.exit(f"istat_ntfs.py: {e} (address {args.address})")
+        finally:
+            ntfs.close()
 
 
 if __name__ == "__main__":
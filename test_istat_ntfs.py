@@ -1,6 +1,8 @@
+import io
 import unittest
 from subprocess import run
 
+import hw5utils
 import istat_ntfs
 import tsk_helper
 
@@ -153,6 +155,28 @@ class TestIstatNtfs(unittest.TestCase):
         actual = mft.parse_data_attr(entry, 240)
         self.assertEqual(actual, expected)
 
+    def test_parse_data_non_resident_large_init_size(self):
+        self.maxDiff = None
+        with open("image.ntfs", "rb") as f:
+            mft = istat_ntfs.ParseMFT(f)
+        init_size = 0x0100000000000000 + 30918  # byte 63 of the attribute is nonzero
+        attribute = (
+            b"\x80\x00\x00\x00"  # type: $DATA
+            + b"\x48\x00\x00\x00"  # attribute length
+            + b"\x01"  # non-resident
+            + bytes(23)
+            + b"\x40\x00"  # runlist offset
+            + bytes(14)
+            + (30918).to_bytes(8, "little")  # size
+            + init_size.to_bytes(8, "little")
+            + b"\x11\x02\x10"  # one run: 2 clusters starting at cluster 16
+            + bytes(5)
+        )
+        entry = attribute + b"\xff\xff\xff\xff"
+        expected = {"type": 128, "size": 30918, "init_size": init_size, "sector_list": [16, 17]}
+        actual = mft.parse_data_attr(entry, 0)
+        self.assertEqual(actual, expected)
+
     # @weight(5)
     def test_image64(self):
 
@@ -241,6 +265,91 @@ class TestIstatNtfs(unittest.TestCase):
         self.fractional_score[self._testMethodName] = jaccard_distance(expected, actual)
         self.assertEqual(expected, actual)
 
+    def test_image64_from_bytesio(self):
+        self.maxDiff = None
+        with open("image.ntfs.64.out") as f:
+            expected = tsk_helper.strip_all(tsk_helper.get_fsstat_output(f))
+        with open("image.ntfs", "rb") as f:
+            mft = istat_ntfs.ParseMFT(io.BytesIO(f.read()))
+        # BytesIO has no fileno, so entries are read with seek/read
+        self.assertIsNone(mft.mm)
+        lines = mft.print_istat_entry(mft.istat_entry(64))
+        actual = tsk_helper.strip_all(lines.split("\n"))
+        self.assertEqual(expected, actual)
+
+    def test_close_falls_back_to_file(self):
+        with open("image.ntfs", "rb") as f:
+            mft = istat_ntfs.ParseMFT(f)
+            self.assertIsNotNone(mft.mm)
+            expected = mft.print_istat_entry(mft.istat_entry(64))
+            mft.close()
+            mft.close()
+            self.assertIsNone(mft.mm)
+            self.assertEqual(mft.print_istat_entry(mft.istat_entry(64)), expected)
+
+
+def _attr_header(type_code, length):
+    """Build an attribute of the given type and total length, zero-filled past its header."""
+    return type_code.to_bytes(4, "little") + length.to_bytes(4, "little") + bytes(length - 8)
+
+
+class TestAttributeIndex(unittest.TestCase):
+    # entry header with the first attribute at offset 0x38
+    HEADER = bytes(20) + (0x38).to_bytes(2, "little") + bytes(0x38 - 22)
+
+    def setUp(self):
+        with open("image.ntfs", "rb") as f:
+            self.mft = istat_ntfs.ParseMFT(f)
+
+    def tearDown(self):
+        self.mft.close()
+
+    def test_missing_attribute(self):
+        # entry 26 has no $DATA attribute
+        with self.assertRaises(istat_ntfs.MissingAttributeError):
+            self.mft.istat_entry(26)
+
+    def test_index_without_end_marker(self):
+        entry = self.HEADER + _attr_header(0x10, 16) + _attr_header(0x30, 16)
+        self.assertEqual(self.mft._index_attrs(entry), {0x10: (56, 72), 0x30: (72, 88)})
+
+    def test_index_stops_at_zero_length(self):
+        entry = self.HEADER + _attr_header(0x10, 16) + b"\x30\x00\x00\x00" + bytes(12)
+        self.assertEqual(self.mft._index_attrs(entry), {0x10: (56, 72)})
+
+    def test_index_keeps_first_of_repeated_type(self):
+        entry = self.HEADER + _attr_header(0x30, 16) + _attr_header(0x30, 24) + b"\xff\xff\xff\xff"
+        self.assertEqual(self.mft._index_attrs(entry), {0x30: (56, 72)})
+
+
+class TestLocaltimeString(unittest.TestCase):
+    def test_fraction_does_not_round_into_next_second(self):
+        self.assertEqual(
+            hw5utils._localtime_string(132000000009999999),
+            "2019-04-17 14:40:00.999999900 (EDT)",
+        )
+
+    def test_pre_epoch_fraction_does_not_round_into_next_second(self):
+        self.assertEqual(
+            hw5utils._localtime_string(116444735999999999),
+            "1969-12-31 18:59:59.999999900 (EDT)",
+        )
+
+    def test_pre_epoch_half_second(self):
+        self.assertEqual(
+            hw5utils._localtime_string(100000000005000000),
+            "1917-11-21 12:46:40.500000000 (EDT)",
+        )
+
+    def test_unix_epoch(self):
+        self.assertEqual(
+            hw5utils._localtime_string(116444736000000000),
+            "1969-12-31 19:00:00.000000000 (EDT)",
+        )
+
+    def test_zero_timestamp(self):
+        self.assertEqual(hw5utils._localtime_string(0), "1601-01-01 00:00:00.000000000 (EDT)")
+
 
 if __name__ == "__main__":
     unittest.main()